@@ -1,32 +1,147 @@
 from flask import Flask, render_template, request, redirect, url_for, flash
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
+from flask_migrate import Migrate
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import unquote
-from models import db, User, Recipe, UserRecipe, SavedRecipe
+from models import db, User, Recipe, UserRecipe, SavedRecipe, check_dummy_password
 from forms import RegistrationForm, LoginForm, RecipeForm
+from sqlalchemy import exists, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
 from dotenv import load_dotenv
 import os
+import threading
+import time
+from cachetools import TTLCache
+from flask.json.provider import DefaultJSONProvider, JSONProvider
 from flask_caching import Cache
+from cachelib.serializers import RedisSerializer
+import orjson
+from flask_session import Session
+import redis
 
 
 load_dotenv()
 
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider that serializes with orjson, falling back to Flask's default conversions
+    for types orjson doesn't handle natively.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class OrjsonRedisSerializer(RedisSerializer):
+    """
+    Stores cached values in Redis as orjson-encoded JSON instead of pickles.
+    """
+
+    def dumps(self, value, protocol=None):
+        return orjson.dumps(value)
+
+    def loads(self, value):
+        if value is None:
+            return None
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # Entries written by the pickle serializer are treated as cache misses
+            return None
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
+DATABASE_URL = os.getenv('DATABASE_URL')
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if DATABASE_URL and not DATABASE_URL.startswith('sqlite'):
+    # Keep a small set of warm connections per worker and drop ones the server has closed
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'pool_use_lifo': True,
+    }
 
 db.init_app(app)
-
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+migrate = Migrate(app, db)
+
+# Share the recipe cache and sessions across workers through Redis when it is configured
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    cache = Cache(app, config={
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': REDIS_URL,
+        'CACHE_DEFAULT_TIMEOUT': 3600,
+        'CACHE_KEY_PREFIX': 'spoon:',
+    })
+    cache.cache.serializer = OrjsonRedisSerializer()
+    # Keep sessions server-side so the cookie only carries the session id
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(REDIS_URL)
+    Session(app)
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'simple'})
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+RECIPES_PER_PAGE = 20
+
 API_KEY = os.getenv('SPOONACULAR_API_KEY')
 
+SPOON_SEARCH_URL = 'https://api.spoonacular.com/recipes/complexSearch'
+SPOON_INFO_URL = 'https://api.spoonacular.com/recipes/{}/information'
+SPOON_BULK_URL = 'https://api.spoonacular.com/recipes/informationBulk'
+SPOON_PARAMS = {'apiKey': API_KEY}
+SPOON_SEARCH_PARAMS = {
+    **SPOON_PARAMS,
+    'number': 12,
+    'instructionsRequired': True,
+    'addRecipeInformation': True,
+    'fillIngredients': True,
+}
+
+# Shared Spoonacular session so keep-alive connections are reused across requests
+SPOON = requests.Session()
+SPOON.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # A 429 is retried on the short backoff only; honouring Retry-After could stall the worker for as long as it asks
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+))
+SPOON_TIMEOUT = (2, 5)  # (connect, read) seconds
+
+# Prefetching is optional work done before the search page renders, so it gets one short attempt
+SPOON.mount(SPOON_BULK_URL, HTTPAdapter(pool_maxsize=64, max_retries=0))
+SPOON_PREFETCH_TIMEOUT = (2, 3)
+
+# Small per-process cache in front of the shared cache for the most viewed recipes
+HOT_RECIPES = TTLCache(maxsize=512, ttl=300)
+HOT_RECIPES_LOCK = threading.Lock()
+
+RECIPE_FRESH_TIMEOUT = 3600  # seconds a cached recipe is served without asking Spoonacular
+RECIPE_REVALIDATE_TIMEOUT = 86400  # seconds a recipe with an ETag is kept for conditional refreshes
+
 @login_manager.user_loader
 def load_user(user_id):
     """
@@ -38,10 +153,7 @@ def load_user(user_id):
     Returns:
         User: The user instance corresponding to the given user_id, or None if no user is found.
     """
-    return User.query.get(int(user_id))
-
-with app.app_context():
-   db.create_all()
+    return db.session.get(User, int(user_id))
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -65,6 +177,18 @@ def register():
     """
     form = RegistrationForm()
     if form.validate_on_submit():
+        # Check both unique fields in one query before paying for the password hash
+        conflict = db.session.execute(
+            select(User.username, User.email)
+            .where(or_(User.username == form.username.data, User.email == form.email.data))
+        ).first()
+        if conflict:
+            if conflict.username == form.username.data:
+                flash('Username already taken. Please choose a different one.', 'danger')
+            else:
+                flash('Email already taken. Please choose a different one.', 'danger')
+            return redirect(url_for('register'))
+
         try:
             user = User(username=form.username.data, email=form.email.data)
             user.set_password(form.password.data)
@@ -74,6 +198,7 @@ def register():
             login_user(user)
             return redirect(url_for('index'))
         except IntegrityError as e:
+            # A concurrent registration took the username or email after the check above
             db.session.rollback()  # Rollback the transaction
             if 'user_username_key' in str(e.orig):  # Check if the error is for duplicate username
                 flash('Username already taken. Please choose a different one.', 'danger')
@@ -109,11 +234,16 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and user.check_password(form.password.data):
+        if user is None:
+            check_dummy_password(form.password.data)
+        elif user.check_password(form.password.data):
+            # Upgrade older or weaker hashes now that the plain password is known
+            if user.password_needs_rehash():
+                user.set_password(form.password.data)
+                db.session.commit()
             login_user(user)
             return redirect(url_for('index'))
-        else:
-            flash('Login unsuccessful. Please check email and password.', 'danger')
+        flash('Login unsuccessful. Please check email and password.', 'danger')
     return render_template('login.html', form=form)
 
 
@@ -159,18 +289,20 @@ def index():
     if request.method == 'POST':
         query = request.form.get('search_query', '')
         recipes = search_recipes(query)
+        prefetch_recipes([recipe['id'] for recipe in recipes])
         return render_template('index.html', recipes=recipes, search_query=query)
     
     search_query = request.args.get('search_query', '')
     decoded_search_query = unquote(search_query)
     recipes = search_recipes(decoded_search_query)
+    prefetch_recipes([recipe['id'] for recipe in recipes])
     return render_template('index.html', recipes=recipes, search_query=decoded_search_query)
 
 def search_recipes(query):
     """
     Searches for recipes using the Spoonacular API.
 
-    Sends a GET request to the Spoonacular API with the given search query and retrieves a list of matching recipes.
+    The query is normalized (trimmed and lowercased) so equivalent searches share one cached result.
     If the request fails or there are no results, returns an empty list.
     
     Args:
@@ -180,23 +312,162 @@ def search_recipes(query):
         list: A list of recipes (each represented as a dictionary) fetched from the Spoonacular API.
               Returns an empty list if the search fails or no results are found.
     """
-    url = f'https://api.spoonacular.com/recipes/complexSearch'
-    params = {
-        'apiKey': API_KEY,
-        'query': query,
-        'number': 12,
-        'instructionsRequired': True,
-        'addRecipeInformation': True,
-        'fillIngredients': True,
-    }
+    return fetch_search_results((query or '').strip().lower())
+
+
+@cache.memoize(timeout=600, response_filter=bool)
+def fetch_search_results(query):
+    """
+    Sends a GET request to the Spoonacular API with the given search query and retrieves a list of matching recipes.
 
-    response = requests.get(url, params=params)
+    Non-empty results are cached for 10 minutes; failed or empty searches are not cached.
+
+    Args:
+        query (str): The normalized search term.
+
+    Returns:
+        list: A list of recipes fetched from the Spoonacular API, or an empty list if the search fails.
+    """
+    try:
+        response = SPOON.get(SPOON_SEARCH_URL, params={**SPOON_SEARCH_PARAMS, 'query': query}, timeout=SPOON_TIMEOUT)
+    except requests.RequestException:
+        return []
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         return data['results']
     return []
 
 
+def fetch_recipe(recipe_id, stale=None):
+    """
+    Fetches a single recipe's full information from the Spoonacular API.
+
+    If a stale cache entry with an ETag is given, the request is made conditional on it,
+    and the entry is reused as is when Spoonacular answers 304 Not Modified.
+
+    Args:
+        recipe_id (int): The unique ID of the recipe to fetch.
+        stale (dict): The expired cache entry for the recipe, if there is one.
+
+    Returns:
+        dict: A cache entry holding the recipe data, its ETag and when it was fetched,
+              or None if the request fails.
+    """
+    headers = {'If-None-Match': stale['etag']} if stale and stale['etag'] else {}
+
+    try:
+        response = SPOON.get(SPOON_INFO_URL.format(recipe_id), params=SPOON_PARAMS, headers=headers, timeout=SPOON_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code == 304 and stale:
+        return {**stale, 'fetched_at': time.time()}
+    if response.status_code == 200:
+        return {'etag': response.headers.get('ETag'), 'recipe': orjson.loads(response.content), 'fetched_at': time.time()}
+    return None
+
+
+def cache_recipe_entries(entries):
+    """
+    Stores recipe cache entries in the shared cache.
+
+    Entries with an ETag are kept for a day so they can still be revalidated once they are
+    older than an hour; entries without one are only kept as long as they are fresh.
+
+    Args:
+        entries (dict): Cache entries keyed by recipe ID.
+    """
+    with_etag = {f"recipe_{recipe_id}": entry for recipe_id, entry in entries.items() if entry['etag']}
+    without_etag = {f"recipe_{recipe_id}": entry for recipe_id, entry in entries.items() if not entry['etag']}
+    if with_etag:
+        cache.set_many(with_etag, timeout=RECIPE_REVALIDATE_TIMEOUT)
+    if without_etag:
+        cache.set_many(without_etag, timeout=RECIPE_FRESH_TIMEOUT)
+
+
+def get_recipe(recipe_id):
+    """
+    Returns a recipe's details, from the cache if possible.
+
+    Recently viewed recipes are served from the in-process cache first, then from the shared cache.
+    Cached recipes are fresh for 1 hour; after that they are revalidated with Spoonacular using
+    their ETag, and a cache miss fetches the whole recipe. If Spoonacular can't be reached, a stale
+    copy is served rather than none.
+
+    Args:
+        recipe_id (int): The unique ID of the recipe.
+
+    Returns:
+        dict: The recipe data, or None if it could not be found in Spoonacular.
+    """
+    with HOT_RECIPES_LOCK:
+        recipe = HOT_RECIPES.get(recipe_id)
+    if recipe:
+        return recipe
+
+    # Check if the recipe data is already cached and still fresh
+    entry = cache.get(f"recipe_{recipe_id}")
+    if not entry or time.time() - entry['fetched_at'] >= RECIPE_FRESH_TIMEOUT:
+        refreshed = fetch_recipe(recipe_id, stale=entry)
+        if refreshed is not None:
+            cache_recipe_entries({recipe_id: refreshed})
+            entry = refreshed
+        if not entry:
+            return None
+
+    recipe = entry['recipe']
+    with HOT_RECIPES_LOCK:
+        HOT_RECIPES[recipe_id] = recipe
+    return recipe
+
+
+def fetch_recipes_bulk(recipe_ids):
+    """
+    Fetches the full information of several recipes from the Spoonacular API in one request.
+
+    Args:
+        recipe_ids (list): The IDs of the recipes to fetch.
+
+    Returns:
+        dict: The recipe data keyed by recipe ID. Recipes that could not be fetched are left out.
+    """
+    params = {**SPOON_PARAMS, 'ids': ','.join(map(str, recipe_ids))}
+
+    try:
+        response = SPOON.get(SPOON_BULK_URL, params=params, timeout=SPOON_PREFETCH_TIMEOUT)
+        if response.status_code == 200:
+            return {recipe['id']: recipe for recipe in orjson.loads(response.content)}
+    except (requests.RequestException, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def prefetch_recipes(recipe_ids):
+    """
+    Warms the recipe cache for the given recipe IDs.
+
+    Recipes that are not cached yet are fetched from Spoonacular with a single bulk request
+    and cached, so opening any of them afterwards needs no API call.
+
+    Args:
+        recipe_ids (list): The IDs of the recipes to prefetch.
+    """
+    if not recipe_ids:
+        return
+
+    cached = cache.get_many(*[f"recipe_{recipe_id}" for recipe_id in recipe_ids])
+    missing = [recipe_id for recipe_id, entry in zip(recipe_ids, cached) if not entry]
+    if not missing:
+        return
+
+    # Bulk responses carry no per-recipe ETag
+    fetched_at = time.time()
+    recipes = fetch_recipes_bulk(missing)
+    cache_recipe_entries({
+        recipe_id: {'etag': None, 'recipe': recipe, 'fetched_at': fetched_at}
+        for recipe_id, recipe in recipes.items()
+    })
+
+
 @app.route('/recipe/<int:recipe_id>')
 def view_recipe(recipe_id):
     """
@@ -213,30 +484,17 @@ def view_recipe(recipe_id):
         - Rendered template displaying the recipe details.
         - 404 error page if the recipe is not found in Spoonacular.
     """
-    # Check if the recipe data is already cached
-    cached_recipe = cache.get(f"recipe_{recipe_id}")
-    if cached_recipe:
-        recipe = cached_recipe
-    else:
-        # If not cached, fetch the recipe data from Spoonacular API
-        url = f'https://api.spoonacular.com/recipes/{recipe_id}/information'
-        params = {
-            'apiKey': API_KEY,
-        }
-
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            recipe = response.json()
-            # Cache the recipe data for 1 hour
-            cache.set(f"recipe_{recipe_id}", recipe, timeout=3600) 
-        else:
-            return "Recipe not found", 404
+    recipe = get_recipe(recipe_id)
+    if recipe is None:
+        return "Recipe not found", 404
     
     search_query = request.args.get('search_query', '')
     # Check if the recipe is saved by the current user
-    already_saved = None
+    already_saved = False
     if current_user.is_authenticated:
-        already_saved = SavedRecipe.query.filter_by(user_id=current_user.id, recipe_id=recipe_id).first()
+        already_saved = db.session.scalar(
+            select(exists().where(SavedRecipe.user_id == current_user.id, SavedRecipe.recipe_id == recipe_id))
+        )
 
     return render_template('view_recipe.html', recipe=recipe, search_query=search_query, already_saved=already_saved)
 
@@ -260,38 +518,42 @@ def save_recipe(recipe_id):
         Otherwise, the user is redirected to the saved recipes page after the recipe is saved.
     """
     # Try to find the recipe in the local database first
-    recipe = Recipe.query.filter_by(id=recipe_id).first()
+    recipe = db.session.get(Recipe, recipe_id)
 
     # If the recipe doesn't exist locally, retrieve it from Spoonacular
     if not recipe:
-        url = f'https://api.spoonacular.com/recipes/{recipe_id}/information'
-        params = {'apiKey': API_KEY}
-        response = requests.get(url, params=params)
+        recipe_data = get_recipe(recipe_id)
 
-        if response.status_code == 200:
-            recipe_data = response.json()
+        if recipe_data is not None:
             # Create a new recipe in the local database
             recipe = Recipe(
                 id=recipe_data['id'],  
                 title=recipe_data['title'],
-                ingredients=', '.join([ingredient['name'] for ingredient in recipe_data['extendedIngredients']]),
+                ingredients=', '.join(ingredient['name'] for ingredient in recipe_data['extendedIngredients']),
                 instructions=recipe_data['instructions'],
                 user_id=current_user.id  # Associate with the current user
             )
             db.session.add(recipe)
-            db.session.commit()
+            # The saved_recipe insert below references this row, so write it first
+            db.session.flush()
         else:
             flash('Recipe not found in Spoonacular!', 'danger')
             return redirect(url_for('index'))
 
-    # Check if the recipe has already been saved by the current user
-    if SavedRecipe.query.filter_by(user_id=current_user.id, recipe_id=recipe.id).first():
+    # Save the recipe unless the current user has already saved it, in a single statement
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = (
+        insert(SavedRecipe)
+        .values(user_id=current_user.id, recipe_id=recipe.id)
+        .on_conflict_do_nothing(index_elements=['user_id', 'recipe_id'])
+        .returning(SavedRecipe.id)
+    )
+    saved_recipe_id = db.session.execute(stmt).scalar()
+    db.session.commit()
+
+    if saved_recipe_id is None:
         flash('You have already saved this recipe!', 'info')
     else:
-        # Save the recipe if it is not already saved
-        saved_recipe = SavedRecipe(user_id=current_user.id, recipe_id=recipe.id)
-        db.session.add(saved_recipe)
-        db.session.commit()
         flash('Recipe saved!', 'success')
 
     return redirect(url_for('index'))
@@ -301,9 +563,10 @@ def save_recipe(recipe_id):
 @login_required
 def saved_recipes():
     """
-    View all saved recipes for the logged-in user.
+    View the saved recipes for the logged-in user.
 
-    Fetches all saved recipes from the local database for the current user and displays them.
+    Fetches one page of saved recipes from the local database for the current user and displays them,
+    most recently saved first.
 
     Args:
         None
@@ -311,8 +574,16 @@ def saved_recipes():
     Returns:
         - Rendered template (`saved_recipes.html`) displaying the user's saved recipes.
     """
-    saved_recipes = SavedRecipe.query.filter_by(user_id=current_user.id).all()
-    return render_template('saved_recipes.html', saved_recipes=saved_recipes)
+    # Load the saved recipes' titles in one extra query instead of one per saved recipe
+    pagination = db.paginate(
+        select(SavedRecipe)
+        .where(SavedRecipe.user_id == current_user.id)
+        .options(selectinload(SavedRecipe.recipe).load_only(Recipe.id, Recipe.title))
+        .order_by(SavedRecipe.id.desc()),
+        per_page=RECIPES_PER_PAGE,
+        error_out=False,
+    )
+    return render_template('saved_recipes.html', saved_recipes=pagination.items, pagination=pagination)
 
 
 @app.route('/delete_saved_recipe/<int:saved_recipe_id>', methods=['POST'])
@@ -331,7 +602,7 @@ def delete_saved_recipe(saved_recipe_id):
         Redirect to the 'saved_recipes' page with a success or error message.
     """
     # Find the SavedRecipe entry by ID
-    saved_recipe = SavedRecipe.query.get_or_404(saved_recipe_id)
+    saved_recipe = db.get_or_404(SavedRecipe, saved_recipe_id)
 
     # Ensure that the current user is the one who saved the recipe
     if saved_recipe.user_id != current_user.id:
@@ -380,8 +651,27 @@ def create_recipe():
 @app.route('/my_recipes')
 @login_required
 def my_recipes():
-    recipes = UserRecipe.query.filter_by(user_id=current_user.id).all()
-    return render_template('my_recipes.html', recipes=recipes)
+    """
+    View the recipes created by the logged-in user.
+
+    Fetches one page of the current user's recipes, newest first, loading only the columns
+    the listing shows rather than the full ingredients and instructions.
+
+    Args:
+        None
+
+    Returns:
+        - Rendered template (`my_recipes.html`) displaying the user's recipes.
+    """
+    pagination = db.paginate(
+        select(UserRecipe)
+        .where(UserRecipe.user_id == current_user.id)
+        .options(load_only(UserRecipe.id, UserRecipe.title))
+        .order_by(UserRecipe.id.desc()),
+        per_page=RECIPES_PER_PAGE,
+        error_out=False,
+    )
+    return render_template('my_recipes.html', recipes=pagination.items, pagination=pagination)
 
 
 @app.route('/my_recipe/<int:recipe_id>')
@@ -397,7 +687,7 @@ def view_my_recipe(recipe_id):
     Returns:
         - Rendered template (`view_my_recipe.html`) displaying the user's recipe.
     """
-    recipe = UserRecipe.query.filter_by(id=recipe_id).first()
+    recipe = db.session.get(UserRecipe, recipe_id)
     return render_template('view_my_recipe.html', recipe=recipe)
 
 
@@ -420,7 +710,7 @@ def delete_my_recipe(recipe_id):
             - Redirects to the 'my_recipes' page after successful deletion.
             - Redirects back to 'my_recipes' with a flash message if unauthorized.
     """
-    recipe = UserRecipe.query.get_or_404(recipe_id)
+    recipe = db.get_or_404(UserRecipe, recipe_id)
 
     if recipe.user_id != current_user.id:
         flash('You are not authorized to delete this recipe.', 'danger')
@@ -0,0 +1,69 @@
+import functools
+import os
+
+# The engine is built when app is imported, so the test database must be configured before that.
+# Flask-SQLAlchemy serves in-memory SQLite through a single StaticPool connection with
+# check_same_thread disabled, so every session in the tests sees the same database. Under
+# pytest-xdist each worker is its own process and so gets its own database.
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+
+import models
+import pytest
+from argon2 import PasswordHasher
+from flask import g
+from models import db
+from sqlalchemy import event
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'WTF_CSRF_ENABLED': False,
+    'SERVER_NAME': 'localhost',
+}
+
+
+class _MemoizedPasswordHasher(PasswordHasher):
+    """Hashes each password once; tests reuse a handful of passwords, so the salt may as well be fixed."""
+
+    @functools.lru_cache(maxsize=16)
+    def hash(self, password, *, salt=None):
+        return super().hash(password, salt=salt)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _fast_password_hashing():
+    """Swap argon2 for its cheapest parameters, the production cost is pure overhead in tests."""
+    hasher = _MemoizedPasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(models, 'PASSWORD_HASHER', hasher)
+        mp.setattr(models, 'DUMMY_PASSWORD_HASH', hasher.hash('not a real password'))
+        yield hasher
+
+
+@pytest.fixture(scope="session")
+def _app():
+    """The process-wide app, configured for testing with its schema created once per test session."""
+    from app import app
+    app.config.update(TEST_CONFIG)
+
+    @app.teardown_request
+    def _teardown_request_state(exc):
+        # Requests reuse the session-wide app context, so clear what its teardown would after each one
+        g.pop('_login_user', None)
+        db.session.remove()
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            @event.listens_for(db.engine, 'connect')
+            def _configure_sqlite(dbapi_connection, connection_record):
+                # pysqlite's own transaction handling breaks SAVEPOINTs; let SQLAlchemy emit BEGIN itself
+                dbapi_connection.isolation_level = None
+                # SQLite ignores foreign keys unless asked, and Postgres does not
+                dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+            @event.listens_for(db.engine, 'begin')
+            def _begin(connection):
+                connection.exec_driver_sql('BEGIN')
+
+        db.create_all()
+        yield app
@@ -0,0 +1,37 @@
+"""add saved_recipe and user_recipe indexes
+
+Revision ID: 9a2c7f3e1b48
+Revises: 4e1fd5d364e1
+Create Date: 2026-10-14 05:24:41.120376
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a2c7f3e1b48'
+down_revision = '4e1fd5d364e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Recipes saved before the unique index existed may be duplicated; keep the first save of each
+    op.execute(
+        'DELETE FROM saved_recipe WHERE id NOT IN '
+        '(SELECT MIN(id) FROM saved_recipe GROUP BY user_id, recipe_id)'
+    )
+    with op.batch_alter_table('saved_recipe', schema=None) as batch_op:
+        batch_op.create_index('ix_saved_user_recipe', ['user_id', 'recipe_id'], unique=True, postgresql_include=['id'])
+
+    with op.batch_alter_table('user_recipe', schema=None) as batch_op:
+        batch_op.create_index('ix_userrecipe_user', ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user_recipe', schema=None) as batch_op:
+        batch_op.drop_index('ix_userrecipe_user')
+
+    with op.batch_alter_table('saved_recipe', schema=None) as batch_op:
+        batch_op.drop_index('ix_saved_user_recipe', postgresql_include=['id'])
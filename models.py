@@ -1,9 +1,23 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 db = SQLAlchemy()
 
+PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Checked against when no user matches, so unknown emails take as long to reject as wrong passwords
+DUMMY_PASSWORD_HASH = PASSWORD_HASHER.hash('not a real password')
+
+
+def check_dummy_password(password):
+    try:
+        PASSWORD_HASHER.verify(DUMMY_PASSWORD_HASH, password)
+    except VerificationError:
+        pass
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
@@ -13,10 +27,19 @@ class User(UserMixin, db.Model):
     saved_recipes = db.relationship('SavedRecipe', backref='user', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = PASSWORD_HASHER.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            # Hashes created with Werkzeug before the switch to argon2
+            return check_password_hash(self.password_hash, password)
+        try:
+            return PASSWORD_HASHER.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def password_needs_rehash(self):
+        return not self.password_hash.startswith('$argon2') or PASSWORD_HASHER.check_needs_rehash(self.password_hash)
 
 class Recipe(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -27,6 +50,8 @@ class Recipe(db.Model):
     saved_by = db.relationship('SavedRecipe', backref='recipe', lazy=True)
 
 class UserRecipe(db.Model):
+    __table_args__ = (db.Index('ix_userrecipe_user', 'user_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     ingredients = db.Column(db.Text, nullable=False)
@@ -35,6 +60,11 @@ class UserRecipe(db.Model):
     image_url = db.Column(db.Text, nullable=True) 
     
 class SavedRecipe(db.Model):
+    # Covers the per-user existence checks and listings; INCLUDE makes them index-only scans on Postgres
+    __table_args__ = (
+        db.Index('ix_saved_user_recipe', 'user_id', 'recipe_id', unique=True, postgresql_include=['id']),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=False)
\ No newline at end of file
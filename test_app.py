@@ -1,133 +1,375 @@
+import orjson
 import pytest
-from app import app, db
+import requests
+import time
+from app import db, cache, HOT_RECIPES
+import models
 from models import User, Recipe, UserRecipe, SavedRecipe
 from unittest.mock import patch
 from flask import url_for
+from types import MappingProxyType, SimpleNamespace
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import scoped_session, sessionmaker
+from werkzeug.security import generate_password_hash
 
+_PASSWORD = "Test1234!"
 
-@pytest.fixture
-def client():
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['TESTING'] = True
-    app.config['WTF_CSRF_ENABLED'] = False  
-    app.config['SERVER_NAME'] = 'localhost'  
+# Form bodies shared by the tests; override single fields with dict(_REG_BODY, username=...)
+_REG_BODY = MappingProxyType(dict(username='testuser2', email='test2@example.com', password=_PASSWORD, confirm_password=_PASSWORD))
+_LOGIN_BODY = MappingProxyType(dict(email='test@example.com', password=_PASSWORD))
+_RECIPE_BODY = MappingProxyType(dict(
+    title="My New Recipe",
+    ingredients="Eggs, Milk, Salt",
+    instructions="Mix it all",
+    image_url="https://example.com/recipe_image.jpg"
+))
+# Rows are inserted as lists of dicts, so the setup for each test is one executemany per table
+_SAMPLE_RECIPE = MappingProxyType(dict(id=1, title="Sample Recipe", ingredients="Chicken, Salt", instructions="Cook it"))
+
+_DEFAULT_PAYLOAD = {'results': []}
+
+
+class _FakeResp:
+    """The parts of a requests.Response the Spoonacular helpers read."""
+
+    def __init__(self, payload=_DEFAULT_PAYLOAD, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = orjson.dumps(payload)
 
-    with app.app_context():  
-        db.create_all()
-        with app.test_client() as client:
-            yield client
 
-        db.session.remove()
-        db.drop_all()
+@pytest.fixture(scope="session")
+def urls(_app):
+    """Test URLs, built once per session."""
+    with _app.test_request_context():
+        return SimpleNamespace(
+            index=url_for('index'),
+            login=url_for('login'),
+            logout=url_for('logout'),
+            register=url_for('register'),
+            create_recipe=url_for('create_recipe'),
+            my_recipes=url_for('my_recipes'),
+            saved_recipes=url_for('saved_recipes'),
+            my_recipes_page=lambda page: url_for('my_recipes', page=page, _external=False),
+            view_recipe=lambda recipe_id: url_for('view_recipe', recipe_id=recipe_id, _external=False),
+            save_recipe=lambda recipe_id: url_for('save_recipe', recipe_id=recipe_id, _external=False),
+            delete_saved_recipe=lambda saved_recipe_id: url_for('delete_saved_recipe', saved_recipe_id=saved_recipe_id, _external=False),
+        )
 
 
 @pytest.fixture
-def new_user():
-    user = User(username="testuser", email="test@example.com")
-    user.set_password("Test1234!")
+def client(_app):
+    """Test client whose database changes are rolled back after each test."""
+    # Join the session to an outer transaction; the app's commits only release savepoints
+    session = db.session
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    db.session = scoped_session(sessionmaker(bind=connection, join_transaction_mode='create_savepoint'))
+
+    with _app.test_client() as client:
+        yield client
+
+    db.session.remove()
+    transaction.rollback()
+    connection.close()
+    db.session = session
+    cache.clear()
+    HOT_RECIPES.clear()
+
+
+@pytest.fixture(autouse=True, scope="module")
+def _spoonacular():
+    """Stands in for every Spoonacular call made by the tests in this module."""
+    with patch('app.SPOON.get') as mock_get:
+        yield mock_get
+
+
+@pytest.fixture(autouse=True)
+def mock_get(_spoonacular):
+    """The Spoonacular mock, reset to an empty successful response for each test."""
+    _spoonacular.reset_mock(side_effect=True)
+    _spoonacular.return_value = _FakeResp()
+    return _spoonacular
+
+
+@pytest.fixture(scope="module")
+def new_user(_app):
+    """User committed once per module, outside the per-test transactions."""
+    # Hashed here rather than at import, so it uses the low-cost hasher from conftest
+    user = User(username="testuser", email="test@example.com", password_hash=models.PASSWORD_HASHER.hash(_PASSWORD))
     db.session.add(user)
     db.session.commit()
-    return user
+    db.session.refresh(user)
+    db.session.close()
+    yield user
+
+    db.session.execute(delete(User).where(User.id == user.id))
+    db.session.commit()
 
 
 @pytest.fixture
-def login_user(client, new_user):
-    client.post(url_for('login'), data=dict(email="test@example.com", password="Test1234!"))
+def login_user(client, new_user, urls):
+    _post(client, urls.login, _LOGIN_BODY)
     return new_user
 
 
-@patch('requests.get')
-def test_search_recipes(mock_get, client):
+def _post(client, endpoint, body, **kwargs):
+    """POST a form body to endpoint without following the redirect unless asked to."""
+    return client.post(endpoint, data=dict(body), **kwargs)
+
+
+def _flashes(client):
+    """Messages flashed by the last response, read from the session instead of a rendered page."""
+    with client.session_transaction() as session:
+        return session.get('_flashes', [])
+
+
+def test_search_recipes(mock_get, client, urls):
     """Test searching for recipes with mocked API response"""
     query = "chicken"
+    results = [
+        {'id': 1, 'title': 'Chicken Curry', 'image': 'https://example.com/curry.jpg'},
+        {'id': 2, 'title': 'Grilled Chicken', 'image': 'https://example.com/grilled.jpg'}
+    ]
 
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.json.return_value = {
-        'results': [
-            {'id': 1, 'title': 'Chicken Curry', 'image': 'https://example.com/curry.jpg'},
-            {'id': 2, 'title': 'Grilled Chicken', 'image': 'https://example.com/grilled.jpg'}
-        ]
-    }
+    def spoonacular(url, params=None, **kwargs):
+        if url.endswith('/informationBulk'):
+            return _FakeResp(results)
+        return _FakeResp({'results': results})
+
+    mock_get.side_effect = spoonacular
 
-    response = client.post(url_for('index'), data={'search_query': query}, follow_redirects=True)
+    response = client.post(urls.index, data={'search_query': query}, follow_redirects=True)
     
     assert response.status_code == 200
     assert b'Results for "chicken"' in response.data  
     assert b'Chicken Curry' in response.data
     assert b'Grilled Chicken' in response.data
 
+    # Details of all results are prefetched with a single bulk request
+    bulk_calls = [call for call in mock_get.call_args_list if call.args[0].endswith('/informationBulk')]
+    assert len(bulk_calls) == 1
+    assert bulk_calls[0].kwargs['params']['ids'] == '1,2'
 
-def test_register(client):
-    """Test user registration route"""
-    response = client.post(url_for('register'), data=dict(
-        username='testuser2',
-        email='test2@example.com',
-        password='Test1234!',
-        confirm_password='Test1234!'
-    ), follow_redirects=True)
+    # Repeating an equivalent search is served from the cache
+    call_count = mock_get.call_count
+    response = client.post(urls.index, data={'search_query': ' Chicken '}, follow_redirects=True)
+    assert b'Chicken Curry' in response.data
+    assert mock_get.call_count == call_count
+
+
+def test_search_recipes_without_prefetch(mock_get, client, urls):
+    """Test search results still render when the bulk prefetch fails"""
+    results = [{'id': 1, 'title': 'Chicken Curry', 'image': 'https://example.com/curry.jpg'}]
+
+    def spoonacular(url, params=None, **kwargs):
+        if url.endswith('/informationBulk'):
+            raise requests.Timeout()
+        return _FakeResp({'results': results})
+
+    mock_get.side_effect = spoonacular
+
+    response = client.post(urls.index, data={'search_query': 'chicken'})
     assert response.status_code == 200
-    assert b'Your account has been created!' in response.data
+    assert b'Chicken Curry' in response.data
+
 
+def test_register(client, urls):
+    """Test user registration route"""
+    response = _post(client, urls.register, _REG_BODY)
+    assert response.status_code == 302
+    assert response.location == urls.index
+    assert ('success', 'Your account has been created!') in _flashes(client)
 
-def test_login(client):
-    """Test user login route"""
-    response = client.post(url_for('login'), data=dict(
-        email='test@example.com',
-        password='Test1234!'
-    ), follow_redirects=True)
+
+@pytest.mark.parametrize('endpoint, method, body, expected', [
+    ('login', 'post', _LOGIN_BODY, b'Logout'),
+    ('logout', 'get', None, b'Login'),
+])
+def test_auth_routes(client, new_user, urls, endpoint, method, body, expected):
+    """Test the login and logout routes land on the expected page"""
+    response = getattr(client, method)(getattr(urls, endpoint), data=body and dict(body), follow_redirects=True)
     assert response.status_code == 200
+    assert expected in response.data
 
 
-def test_logout(client):
-    """Test user logout route"""
-    response = client.get(url_for('logout'), follow_redirects=True)
+def test_login_session_reloads_user(client, login_user, urls):
+    """Test a later request loads the logged-in user from the session cookie"""
+    response = client.get(urls.my_recipes)
     assert response.status_code == 200
-    assert b'Login' in response.data 
 
 
-def test_create_recipe(client, login_user):
+def test_register_duplicate_username(client, new_user, urls):
+    """Test registering with a username that is already taken"""
+    response = _post(client, urls.register, dict(_REG_BODY, username='testuser', email='other@example.com'))
+    assert response.status_code == 302
+    assert response.location == urls.register
+    assert ('danger', 'Username already taken. Please choose a different one.') in _flashes(client)
+    assert db.session.scalar(select(func.count(User.id))) == 1
+
+
+def test_login_rehashes_legacy_password(client, urls):
+    """Test logging in upgrades a Werkzeug password hash to argon2"""
+    user = User(username="legacyuser", email="legacy@example.com", password_hash=generate_password_hash(_PASSWORD, method="pbkdf2:sha256:1"))
+    db.session.add(user)
+    db.session.commit()
+
+    response = _post(client, urls.login, dict(_LOGIN_BODY, email="legacy@example.com"))
+    assert response.status_code == 302
+
+    password_hash = db.session.scalar(select(User.password_hash).where(User.email == "legacy@example.com"))
+    assert password_hash.startswith('$argon2')
+    assert User(password_hash=password_hash).check_password(_PASSWORD)
+
+
+def test_create_recipe(client, login_user, urls):
     """Test creating a new recipe"""
-    response = client.post(url_for('create_recipe'), data=dict(
-        title="My New Recipe",
-        ingredients="Eggs, Milk, Salt",
-        instructions="Mix it all",
-        image_url="https://example.com/recipe_image.jpg"
-    ), follow_redirects=True)
-    assert response.status_code == 200
-    assert b'Your recipe has been created!' in response.data
+    response = _post(client, urls.create_recipe, _RECIPE_BODY)
+    assert response.status_code == 302
+    assert response.location == urls.index
+    assert ('success', 'Your recipe has been created!') in _flashes(client)
 
-    recipe = UserRecipe.query.filter_by(title="My New Recipe").first()
-    assert recipe is not None
+    recipe_id = db.session.scalar(select(UserRecipe.id).where(UserRecipe.title == "My New Recipe"))
+    assert recipe_id is not None
 
 
-def test_save_recipe(client, login_user):
+def test_save_recipe(client, login_user, urls):
     """Test saving a recipe to the saved list"""
-    recipe = Recipe(id=1, title="Sample Recipe", ingredients="Chicken, Salt", instructions="Cook it", user_id=login_user.id)
-    db.session.add(recipe)
+    db.session.execute(insert(Recipe), [dict(_SAMPLE_RECIPE, user_id=login_user.id)])
     db.session.commit()
 
-    response = client.get(url_for('save_recipe', recipe_id=1), follow_redirects=True)
-    assert response.status_code == 200
-    assert b'Recipe saved!' in response.data
+    response = client.get(urls.save_recipe(1))
+    assert response.status_code == 302
+    assert response.location == urls.index
+    assert ('success', 'Recipe saved!') in _flashes(client)
+
+    saved_recipe_id = db.session.scalar(select(SavedRecipe.id).where(SavedRecipe.user_id == login_user.id, SavedRecipe.recipe_id == 1))
+    assert saved_recipe_id is not None
+
+
+def test_save_recipe_from_spoonacular(mock_get, client, login_user, urls):
+    """Test saving a recipe that is not stored locally fetches it from Spoonacular first"""
+    mock_get.return_value = _FakeResp({
+        'id': 7,
+        'title': 'Tomato Soup',
+        'extendedIngredients': [{'name': 'tomato'}, {'name': 'salt'}],
+        'instructions': 'Simmer the tomatoes.',
+    })
+
+    response = client.get(urls.save_recipe(7))
+    assert response.status_code == 302
+    assert ('success', 'Recipe saved!') in _flashes(client)
 
-    saved_recipe = SavedRecipe.query.filter_by(user_id=login_user.id, recipe_id=1).first()
-    assert saved_recipe is not None
+    recipe = db.session.execute(select(Recipe.title, Recipe.ingredients).where(Recipe.id == 7)).one()
+    assert recipe == ('Tomato Soup', 'tomato, salt')
+    saved_recipe_id = db.session.scalar(select(SavedRecipe.id).where(SavedRecipe.user_id == login_user.id, SavedRecipe.recipe_id == 7))
+    assert saved_recipe_id is not None
 
 
-def test_delete_saved_recipe(client, login_user):
+def test_delete_saved_recipe(client, login_user, urls):
     """Test deleting a saved recipe"""
+    db.session.execute(insert(Recipe), [dict(_SAMPLE_RECIPE, user_id=login_user.id)])
+    saved_recipe_id = db.session.scalar(insert(SavedRecipe).values(user_id=login_user.id, recipe_id=1).returning(SavedRecipe.id))
+    db.session.commit()
+
+    response = client.post(urls.delete_saved_recipe(saved_recipe_id))
+    assert response.status_code == 302
+    assert response.location == urls.saved_recipes
+    assert ('success', 'Recipe removed from your saved list!') in _flashes(client)
+
+    assert db.session.scalar(select(SavedRecipe.id).where(SavedRecipe.id == saved_recipe_id)) is None
+
+
+def test_save_recipe_twice(client, login_user, urls):
+    """Test saving the same recipe twice only stores it once"""
+    db.session.execute(insert(Recipe), [dict(_SAMPLE_RECIPE, user_id=login_user.id)])
+    db.session.commit()
+
+    client.get(urls.save_recipe(1))
+    response = client.get(urls.save_recipe(1))
+    assert response.status_code == 302
+    assert ('info', 'You have already saved this recipe!') in _flashes(client)
+
+    saved_count = db.session.scalar(select(func.count(SavedRecipe.id)).where(SavedRecipe.user_id == login_user.id, SavedRecipe.recipe_id == 1))
+    assert saved_count == 1
+
 
-    recipe = Recipe(id=1, title="Sample Recipe", ingredients="Chicken, Salt", instructions="Cook it", user_id=login_user.id)
-    db.session.add(recipe)
+def test_saved_recipes(client, login_user, urls):
+    """Test listing the user's saved recipes"""
+    db.session.execute(insert(Recipe), [dict(_SAMPLE_RECIPE, user_id=login_user.id)])
+    db.session.execute(insert(SavedRecipe), [dict(user_id=login_user.id, recipe_id=1)])
     db.session.commit()
 
-    saved_recipe = SavedRecipe(user_id=login_user.id, recipe_id=1)
-    db.session.add(saved_recipe)
+    response = client.get(urls.saved_recipes)
+    assert response.status_code == 200
+    assert b'Sample Recipe' in response.data
+
+
+def test_view_recipe_is_cached(mock_get, client, urls):
+    """Test viewing a recipe twice only fetches it from Spoonacular once"""
+    mock_get.return_value = _FakeResp({
+        'id': 42,
+        'title': 'Tomato Soup',
+        'extendedIngredients': [{'name': 'tomato', 'original': '4 tomatoes'}],
+        'analyzedInstructions': [{'steps': [{'step': 'Simmer the tomatoes.'}]}],
+    }, headers={'ETag': '"v1"'})
+
+    for _ in range(2):
+        response = client.get(urls.view_recipe(42))
+        assert response.status_code == 200
+        assert b'Tomato Soup' in response.data
+
+    assert mock_get.call_count == 1
+
+
+def test_view_recipe_revalidates_with_etag(mock_get, client, urls):
+    """Test an expired cached recipe is reused when Spoonacular answers 304"""
+    recipe = {
+        'id': 42,
+        'title': 'Tomato Soup',
+        'extendedIngredients': [],
+        'analyzedInstructions': [{'steps': []}],
+    }
+    cache.set("recipe_42", {'etag': '"v1"', 'recipe': recipe, 'fetched_at': 0})
+    mock_get.return_value = _FakeResp(status_code=304)
+
+    response = client.get(urls.view_recipe(42))
+    assert response.status_code == 200
+    assert b'Tomato Soup' in response.data
+
+    assert mock_get.call_args.kwargs['headers'] == {'If-None-Match': '"v1"'}
+    assert cache.get("recipe_42")['fetched_at'] > 0
+
+
+def test_my_recipes_pagination(client, login_user, urls):
+    """Test the user's recipes are listed 20 per page, newest first"""
+    db.session.execute(insert(UserRecipe), [
+        dict(title=f"Recipe {i}", ingredients="Eggs", instructions="Mix", user_id=login_user.id) for i in range(21)
+    ])
     db.session.commit()
 
-    response = client.post(url_for('delete_saved_recipe', saved_recipe_id=saved_recipe.id), follow_redirects=True)
+    response = client.get(urls.my_recipes)
     assert response.status_code == 200
-    assert b'Recipe removed from your saved list!' in response.data
+    assert b'Recipe 20' in response.data
+    assert b'Recipe 0<' not in response.data
+    assert b'Page 1 of 2' in response.data
+
+    response = client.get(urls.my_recipes_page(2))
+    assert b'Recipe 0<' in response.data
 
-    saved_recipe = SavedRecipe.query.filter_by(user_id=login_user.id, recipe_id=1).first()
-    assert saved_recipe is None
+
+def test_view_saved_recipe_hides_save_button(client, login_user, urls):
+    """Test a recipe the user has saved is shown without the save button"""
+    db.session.execute(insert(Recipe), [dict(_SAMPLE_RECIPE, user_id=login_user.id)])
+    db.session.execute(insert(SavedRecipe), [dict(user_id=login_user.id, recipe_id=1)])
+    db.session.commit()
+    cache.set("recipe_1", {
+        'etag': None,
+        'recipe': {'id': 1, 'title': 'Sample Recipe', 'extendedIngredients': [], 'analyzedInstructions': [{'steps': []}]},
+        'fetched_at': time.time(),
+    })
+
+    response = client.get(urls.view_recipe(1))
+    assert response.status_code == 200
+    assert b'Sample Recipe' in response.data
+    assert b'Save Recipe' not in response.data